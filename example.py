@@ -17,15 +17,15 @@ nexos.init_udp("192.168.3.220", port=7777)
 #nexos.init_serial()
 
 nexos.stop_streaming()
-nexos.set_recv_ip("192.168.3.4")
+# all settings at once, same as set_recv_ip, set_channel, set_equalizer, set_gain and set_srate. Commands are sent
+# back-to-back (chained=False) until ';' chaining is confirmed on the device
+nexos.batch("SYSTem:COMMunicate:LAN:RADDRess \"192.168.3.4\"",
+            "INPut1:STATe 1",
+            "INPut1:EQUalizer:STATe 0",
+            "INPut1:GAIN:STATe 1",
+            "CONFigure:ACQuire:SRATe 100000",
+            chained=False)
 # nexos.set_recv_port(4002) # automatico
-
-nexos.set_channel(1)
-nexos.set_equalizer(False)
-nexos.set_gain(True)
-print("---> set SRATE")
-nexos.set_srate(100000)
-print("----------------------")
 nexos.start_streaming()
 nexos.write_wav(10, "100k_ch1")
 
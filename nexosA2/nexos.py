@@ -10,36 +10,119 @@ created: 20/11/23
 """
 
 from argparse import ArgumentParser
+import ctypes
+import ctypes.util
+import errno
+import io
+import logging
+import os
 import serial
 import rich
 import socket
+import struct
+import sys
 import time
+import numpy as np
 import pandas as pd
-import wave
-from mutagen.id3 import ID3, TXXX
-from mutagen.wave import WAVE
 from threading import Thread
+from .ringbuffer import NeXOSRingBuffer, NeXOSShardedRing
+from .uring_writer import open_wav_writer
+from .wavwriter import id3_chunk
 
 
-def add_id3_tags(filename, tags):
-    t = time.time()
-    wave = WAVE(filename)
-    wave.add_tags()
-    id3 = wave.tags
-    for key, value in tags.items():
-        # Add a custom TXXX frame to the ID3 tag
-        id3.add(TXXX(encoding=3, desc=key, text=[value]))
-    wave.save()
-    rich.print(f"[purple]ID3 - Added tags to file {filename} took {1000*(time.time() - t):.02} msecs")
+# ---- recvmmsg bindings (not exposed by the socket module) ---- #
+MSG_WAITFORONE = 0x10000  # linux: block only until the first message has been received
 
 
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IOVec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_recvmmsg():
+    """
+    Returns libc's recvmmsg function or None if it is not available in this platform
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        func = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    func.restype = ctypes.c_int
+    return func
+
+
+_recvmmsg = _load_recvmmsg()
+
+# per-command messages go through logging (debug), so they cost nothing unless enabled
+log = logging.getLogger("nexos")
+
+# RTP header: version, payload type, sequence number, timestamp (ns) and timestamp (s), 12 bytes big endian
+_HDR = struct.Struct(">BBHII")
+
+
+class _SerialRaw(io.RawIOBase):
+    """
+    Raw stream over a pyserial port that only reads the bytes already waiting (at least 1), so a BufferedReader on
+    top of it returns a line as soon as it arrives instead of waiting to fill its whole buffer
+    """
+    def __init__(self, port):
+        super().__init__()
+        self.port = port
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.port.read(max(1, min(len(b), self.port.in_waiting)))
+        b[:len(data)] = data
+        return len(data)  # 0 (EOF for BufferedReader) if the port timed out
+
+
+class _RxShard:
+    """
+    Stream socket with its own ring buffer (and recvmmsg headers pointing to it), filled by a dedicated thread
+    """
+    def __init__(self, sock, ring):
+        self.sock = sock
+        self.ring = ring
+        self.mmsg_iovs = None
+        self.mmsg_hdrs = None  # mmsghdr array pointing to the ring slots, None if recvmmsg is not available
+        self.thread = None
+
 
 class NeXOS:
-    def __init__(self):
+    def __init__(self, recv_buf=12 << 20, recv_batch=64, ring_packets=1024, use_uring=False, rx_workers=1):
+        """
+        :param recv_buf: requested SO_RCVBUF size (bytes) for the RTP stream socket. The kernel silently caps this
+                         value at net.core.rmem_max, so raise it first, e.g. 'sysctl -w net.core.rmem_max=12582912'
+        :param recv_batch: max number of RTP packets read with a single recvmmsg call (linux only)
+        :param ring_packets: packets buffered between the receiver thread and the wav writer (1024 ~ 2.6 s at 200 kHz)
+        :param use_uring: write wav files with io_uring + O_DIRECT (linux, requires liburing), buffered I/O otherwise
+        :param rx_workers: number of receiver sockets/threads bound to the stream port with SO_REUSEPORT. Note that
+                           the kernel spreads packets across sockets by flow hash, so a single stream is only split if
+                           it comes from several source addresses/ports
+        """
         self.interface = None
         self.socket = None
         self.serial = None
         self.address = None
+        self.timeout = 0.25  # seconds to wait for a response before re-sending a query
+        self._serial_buf = None  # io.BufferedReader over the serial port
+        self._udp_buf = bytearray()  # data received via UDP not returned yet
 
 
         # ---- RTSP Streams config ---- #
@@ -54,9 +137,21 @@ class NeXOS:
         self.packetSize = 1036
         self.samplesPerPacket = 512
         self.open_stream_port = False
+        self.recv_buf = recv_buf  # requested receive buffer for the stream socket
+        self.recv_batch = recv_batch  # packets per recvmmsg call
+        self.ring_packets = ring_packets
+        self.use_uring = use_uring
+        self.rx_workers = rx_workers
+        self._shards = []  # one _RxShard (socket + ring + receiver thread) per rx worker
+        self._ring = None  # ring read by the wav writer, NeXOSShardedRing if there are several rx workers
+        self._rx_running = False
+        self._rx_error = None  # exception raised within the receiver thread
+        self._rx_stale = False  # packets queued since the last acquisition, with the stream left open
 
         # ---- config info ---- #
         self.config_info = {}  # dict with the configuration
+        self._config_dirty = True  # config_info has to be reloaded from the hydrophone
+        self.last_samples = None  # int16 samples of the last write_wav acquisition (view of the acquisition buffer)
 
         self.ch = -1
         self.srate = -1
@@ -78,29 +173,26 @@ class NeXOS:
                                     parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE,
                                     xonxoff=0,  # software flow control
                                     rtscts=0)  # hardware flow control
+        # BufferedReader gives a C-level readline, _SerialRaw avoids blocking until its buffer is full
+        self._serial_buf = io.BufferedReader(_SerialRaw(self.serial), buffer_size=4096)
 
         if not self.interface:
             rich.print("Assigning serial port as default interface...")
             self.interface = "serial"
 
     def recv_serial(self, n=256):
-        response = ""
-        end = False
-        time.sleep(0.1)
-        while not end and len(response) < n:
-            c = self.serial.read(1).decode()
-            rich.print(f"[red]{c}", end="")
-            response += c
-            if response.endswith("\r\n"):
-                end = True
-        return response.replace("\r\n", "")
+        # readline returns as soon as the terminator arrives (or after the serial timeout)
+        response = self._serial_buf.readline(n)
+        if not response.endswith(b"\n") and len(response) < n:
+            raise TimeoutError("serial response timed out")
+        return response.rstrip(b"\r\n").decode()
 
     def send_serial(self, cmd):
         if type(cmd) is str:
             cmd = cmd.encode()
         assert(type(cmd) == bytes)
         r = self.serial.write(cmd)
-        time.sleep(0.2)
+        self.serial.flush()
         return r
 
     # -------- UDP functions ---------- #
@@ -120,6 +212,7 @@ class NeXOS:
         self.socket.sendto(b"*idn?\n\r", self.nexos_address)
         data = self.recv_udp()
         rich.print(f"[green]done[white] {data}")
+        self.socket.settimeout(self.timeout)  # the hydrophone answers within network latency
 
         if not self.interface:
             rich.print("Assigning udp as default interface...")
@@ -127,16 +220,28 @@ class NeXOS:
 
 
     def recv_udp(self):
-        buffer = ""
-        end = f"\r\n"
-        rn_found = False
-        while not rn_found:
-            data = self.socket.recv(1024)
-            buffer += data.decode()
+        return self.recv_until(b"\r\n").decode()
 
-            if buffer[-2:] == end:
-                rn_found = True
-        return buffer.replace("\r\n", "")
+    def recv_until(self, terminator=b"\r\n") -> bytes:
+        """
+        Returns the next message received via UDP ending with terminator (not included). Data received after the
+        terminator, e.g. several responses in a single datagram, is kept for the next call
+        :param terminator: end of message
+        """
+        buffer = self._udp_buf
+        start = 0
+        i = buffer.find(terminator)
+        while i < 0:
+            start = max(len(buffer) - len(terminator) + 1, 0)
+            try:
+                buffer.extend(self.socket.recv(1024))
+            except (TimeoutError, socket.timeout):  # socket.timeout is not a TimeoutError before python 3.10
+                buffer.clear()  # drop the partial message
+                raise
+            i = buffer.find(terminator, start)
+        message = bytes(buffer[:i])
+        del buffer[:i + len(terminator)]
+        return message
 
     def send_udp(self, cmd):
         if type(cmd) is str:
@@ -173,14 +278,44 @@ class NeXOS:
         else:
             rich.print("[red]interface not properly set!")
 
-    def query(self, command: str) -> str:
-        rich.print(f"[purple]  TX: '{command}'")
-        self.send(command)
-        r = self.recv()
-        rich.print(f"[cyan]  RX: '{r}'")
+    def query(self, command: str, retries=1) -> str:
+        """
+        Sends a command and waits for its response, if it times out the command is re-sent up to 'retries' times
+        """
+        log.debug("TX: '%s'", command)
+        for attempt in range(retries + 1):
+            self._drain()
+            self.send(command)
+            try:
+                r = self.recv()
+                break
+            except (TimeoutError, socket.timeout):
+                if attempt == retries:
+                    raise
+                self.warnmsg(f"no response to '{command}', retrying...")
+        log.debug("RX: '%s'", r)
         r = r.replace("\"", "")
         return r
 
+    def _drain(self):
+        """
+        Discards any pending response (e.g. the late answer to a query that timed out and was re-sent), so it is not
+        taken as the response to the next command
+        """
+        if self.interface == "udp":
+            self._udp_buf.clear()
+            self.socket.settimeout(0)
+            try:
+                while True:
+                    self.socket.recv(1024)
+            except (BlockingIOError, socket.timeout):
+                pass
+            finally:
+                self.socket.settimeout(self.timeout)
+        elif self.interface == "serial":
+            self.serial.reset_input_buffer()
+            self._serial_buf = io.BufferedReader(_SerialRaw(self.serial), buffer_size=4096)
+
     def set(self, param, value, enclose=False):
         if type(value) != str:
             value = str(value)
@@ -189,14 +324,57 @@ class NeXOS:
         else:
             cmd = f"{param} \"{value}\""
 
-        rich.print(f"[green]Setting {cmd}")
+        log.debug("Setting %s", cmd)
         self.send(cmd)
-        time.sleep(0.2)
         returned_value = self.query(f"{param}?")
         if returned_value != value:
             rich.print(f"expected '{value}' got {returned_value}")
             raise ValueError(f"could not set param {param}!!")
 
+    def batch(self, *cmds, chained=True, verify=True) -> list:
+        """
+        Sends several commands at once and then reads all the responses, instead of a round-trip per command
+        :param cmds: commands, e.g. "INPut1:STATe 1", "CONFigure:ACQuire:SRATe?"
+        :param chained: join the commands with ';:' in a single line, if the firmware does not accept chained commands
+                        set it to False and they will be sent back-to-back without waiting for the responses
+        :param verify: query every set command afterwards and raise ValueError if the value was not applied
+        :return: list with the responses to the queries ('?' commands), in order
+        """
+        cmds = list(cmds)
+        expected = {}  # param -> value for every set command with a value, commands like *RST are not verified
+        for cmd in cmds:
+            if not cmd.endswith("?"):
+                self._config_dirty = True
+                if " " in cmd:
+                    param, value = cmd.split(" ", 1)
+                    expected[param] = value.replace("\"", "")
+        if verify:
+            cmds += [f"{param}?" for param in expected.keys()]
+
+        log.debug("Batch %s", cmds)
+        self._drain()
+        if chained:
+            # a leading ':' makes every header absolute, otherwise SCPI resolves it relative to the previous one
+            self.send(";".join(c if c.startswith(("*", ":")) or i == 0 else f":{c}" for i, c in enumerate(cmds)))
+        else:
+            for cmd in cmds:
+                self.send(cmd)
+
+        # responses may arrive one per line or several in a single line separated by ';'
+        nreplies = sum(cmd.endswith("?") for cmd in cmds)
+        replies = []
+        while len(replies) < nreplies:
+            replies += self.recv().replace("\"", "").split(";")
+
+        if verify:
+            returned = replies[len(replies) - len(expected):]
+            replies = replies[:len(replies) - len(expected)]
+            for (param, value), returned_value in zip(expected.items(), returned):
+                if returned_value != value:
+                    rich.print(f"expected '{value}' got {returned_value}")
+                    raise ValueError(f"could not set param {param}!!")
+        return replies
+
     def set_interface(self, interface):
         """
         Select 'serial' or 'udp' interface
@@ -240,6 +418,7 @@ class NeXOS:
         __valid_srates = [100000, 50000, 200000]
         assert (type(srate) is int)
         assert (srate in __valid_srates)
+        self._config_dirty = True
         return self.set("CONFigure:ACQuire:SRATe", srate)
 
 
@@ -254,6 +433,7 @@ class NeXOS:
     def set_channel(self, ch: int):
         assert (ch in [1, 2])
         cmd = f"INPut{ch}:STATe"
+        self._config_dirty = True
         self.set(cmd, 1)
 
     def get_channel(self):
@@ -266,6 +446,7 @@ class NeXOS:
     # -------- Channel 1 Gain -------- #
     def set_gain(self, value: bool):  # only channel 1
         assert(type(value) is bool)
+        self._config_dirty = True
         if value:
             self.set("INPut1:GAIN:STATe", 1)
         else:
@@ -277,6 +458,7 @@ class NeXOS:
     # -------- Channel 1 Equalizer -------- #
     def set_equalizer(self, value: bool):  # only for channel 1
         assert (type(value) is bool)
+        self._config_dirty = True
         self.set("INPut1:EQUalizer:STATe", int(value))
 
     def get_equalizer(self)-> str: # only for channel 1
@@ -292,89 +474,358 @@ class NeXOS:
 
     # Opens an UDP socket at @port to receive data from the hydrophone
     def open_stream(self, port):
-        self.stream_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # open_stream socket
-        self.stream_socket.bind(('', port))  # bind socket to port
+        """
+        Opens the RTP stream socket with an enlarged receive buffer (self.recv_buf). The kernel caps SO_RCVBUF at
+        net.core.rmem_max, so if a warning is shown run 'sysctl -w net.core.rmem_max=12582912' (as root). If
+        rx_workers > 1, rx_workers sockets are bound to the same port with SO_REUSEPORT, each one with its own
+        receiver thread and ring, and the packets are merged back in RTP sequence order
+        :param port: UDP port where the hydrophone sends the stream
+        """
+        reuseport = self.rx_workers > 1
+        self._shards = []
+        for _ in range(self.rx_workers):
+            shard = _RxShard(self._open_stream_socket(port, reuseport),
+                             NeXOSRingBuffer(self.ring_packets, self.packetSize))
+            if _recvmmsg:
+                self._setup_recv_batch(shard)
+            self._shards.append(shard)
+        self.stream_socket = self._shards[0].sock
         self.open_stream_port = True
+        self._rx_stale = False
+
+        if reuseport:
+            self._ring = NeXOSShardedRing([shard.ring for shard in self._shards])
+        else:
+            self._ring = self._shards[0].ring
+        self._start_rx()
+
+    def _start_rx(self):
+        self._rx_error = None
+        self._rx_running = True
+        for shard in self._shards:
+            shard.thread = Thread(target=self._rx_loop, args=(shard,), daemon=True)
+            shard.thread.start()
+
+    def _stop_rx(self):
+        self._rx_running = False
+        for shard in self._shards:
+            shard.thread.join()
+
+    def _open_stream_socket(self, port, reuseport=False) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # open_stream socket
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buf)
+        applied = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if sys.platform.startswith("linux"):
+            applied //= 2  # Linux reports twice the value set (bookkeeping overhead)
+        if applied < self.recv_buf:
+            self.warnmsg(f"SO_RCVBUF is {applied} bytes, requested {self.recv_buf}. Increase net.core.rmem_max, "
+                         f"e.g. 'sysctl -w net.core.rmem_max={self.recv_buf}'")
+        if reuseport:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # periodic timeout so that the receiver thread can check if it has to stop
+        if _recvmmsg:
+            # recvmmsg bypasses the socket module, so the timeout has to be set at kernel level (struct timeval)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack("ll", 0, 200000))
+        else:
+            sock.settimeout(0.2)
+        sock.bind(('', port))  # bind socket to port
+        return sock
+
+    def _setup_recv_batch(self, shard):
+        """
+        Pre-allocates one mmsghdr/iovec per ring slot, so recvmmsg stores the packets straight into the ring
+        """
+        ring = shard.ring
+        n = ring.capacity
+        base = ctypes.addressof((ctypes.c_char * len(ring.buffer)).from_buffer(ring.buffer))
+        shard.mmsg_iovs = (_IOVec * n)()
+        shard.mmsg_hdrs = (_MMsgHdr * n)()
+        for i in range(n):
+            shard.mmsg_iovs[i].iov_base = base + i * self.packetSize
+            shard.mmsg_iovs[i].iov_len = self.packetSize
+            shard.mmsg_hdrs[i].msg_hdr.msg_iov = ctypes.pointer(shard.mmsg_iovs[i])
+            shard.mmsg_hdrs[i].msg_hdr.msg_iovlen = 1
+
+    def _recv_batch(self, shard, nmsgs=64) -> int:
+        """
+        Receives up to nmsgs packets with a single recvmmsg syscall into the free slots at the head of the shard's
+        ring and commits them. Blocks until at least one packet is available or the socket timeout expires
+        :param shard: _RxShard to receive from
+        :param nmsgs: max number of packets to receive
+        :return: number of packets received
+        """
+        ring = shard.ring
+        slot = ring.head_slot()
+        nmsgs = min(nmsgs, ring.writable())
+        if nmsgs < 1:
+            time.sleep(0.001)  # ring full, let the kernel buffer absorb the packets
+            return 0
+        hdrs = ctypes.addressof(shard.mmsg_hdrs) + slot * ctypes.sizeof(_MMsgHdr)
+        n = _recvmmsg(shard.sock.fileno(), hdrs, nmsgs, MSG_WAITFORONE, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise OSError(err, os.strerror(err))
+        for i in range(slot, slot + n):
+            ring.commit(shard.mmsg_hdrs[i].msg_len)
+        return n
+
+    def _recv_one(self, shard) -> int:
+        """
+        Receives a single packet into the head slot of the shard's ring (used when recvmmsg is not available)
+        :return: number of packets received
+        """
+        ring = shard.ring
+        if ring.writable() < 1:
+            time.sleep(0.001)
+            return 0
+        try:
+            nbytes = shard.sock.recv_into(ring.slot(ring.head_slot()))
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            return 0
+        ring.commit(nbytes)
+        return 1
+
+    def _rx_loop(self, shard):
+        """
+        Receiver thread, it only moves packets from the shard's socket to its ring buffer
+        """
+        try:
+            while self._rx_running:
+                if shard.mmsg_hdrs is not None:
+                    self._recv_batch(shard, self.recv_batch)
+                else:
+                    self._recv_one(shard)
+        except Exception as e:
+            self._rx_error = e
+            self._rx_running = False
+
+    def _acquire(self, mv, npackets) -> int:
+        """
+        Consumes the next npackets RTP packets from the ring and copies their payload, back to back, into mv. This is
+        the hot loop, so everything is bound to locals and the RTP state is only stored back in self at the end
+        :param mv: writable memoryview with room for npackets payloads
+        :param npackets: number of packets to acquire
+        :return: number of bytes written into mv
+        """
+        ring = self._ring
+        peek = ring.peek
+        release = ring.release
+        unpack_from = _HDR.unpack_from
+        sleep = time.sleep
+        prev = self.newSeqNum  # -1 if unknown
+        old = self.oldSeqNum
+        header = None
+        lost = 0  # lost packets not reported yet, reported at most once per second
+        short = 0  # datagrams too short to hold an RTP header, discarded
+        odd = 0  # datagrams with an odd payload length (not whole 16-bit samples), discarded
+        last_report = time.monotonic()
+        off = 0
+        count = 0
+        while count < npackets:
+            packet = peek()
+            if packet is None:
+                if not self._rx_running:
+                    raise RuntimeError(f"receiver thread stopped: {self._rx_error}")
+                sleep(0.001)
+                continue
+            if len(packet) < 12:
+                release()  # not an RTP packet (stray datagram on the stream port)
+                short += 1
+                continue
+            if len(packet) & 1:
+                release()  # payload is 12 bytes shorter, odd too: it would misalign the samples
+                odd += 1
+                continue
+            header = unpack_from(packet, 0)
+            seq = header[2]
+            end = off + len(packet) - 12
+            mv[off:end] = packet[12:]
+            release()
+            off = end
+            count += 1
+            if prev >= 0 and seq - prev > 1:
+                lost += seq - prev - 1
+                if time.monotonic() - last_report > 1:
+                    self.warnmsg("Lost:", lost, "packets")
+                    lost = 0
+                    last_report = time.monotonic()
+            old = prev
+            prev = seq
+
+        if lost:
+            self.warnmsg("Lost:", lost, "packets")
+        if short:
+            self.warnmsg("Discarded", short, "datagrams shorter than the RTP header")
+        if odd:
+            self.warnmsg("Discarded", odd, "datagrams with an odd payload length")
+        if header:
+            self.rtpVersion, self.rtpPayloadType, self.rtpSeqNum, self.rtpTimestampNs, self.rtpTimestampS = header
+            self.oldSeqNum = old if old >= 0 else prev - 1
+            self.newSeqNum = prev
+        return off
+
+    def _ensure_stream(self):
+        """
+        Opens the stream if it is not open, or reopens it if its receiver thread has stopped (e.g. after an error)
+        """
+        if self.open_stream_port and not self._rx_running:
+            self.close_stream()
+        if not self.open_stream_port:
+            self.open_stream(self.streaming_port)
+        elif self._rx_stale:
+            self._discard_queued()
+
+    def _discard_queued(self):
+        """
+        Discards the packets queued in the rings and socket buffers while the stream was left open between
+        acquisitions (close=False), so that the new recording starts with fresh audio
+        """
+        self._stop_rx()
+        for shard in self._shards:
+            timeout = shard.sock.gettimeout()
+            shard.sock.settimeout(0)
+            try:
+                while True:
+                    shard.sock.recv(self.packetSize)
+            except (BlockingIOError, socket.timeout):
+                pass
+            finally:
+                shard.sock.settimeout(timeout)
+        self._ring.reset()
+        self.newSeqNum = self.oldSeqNum = -1  # do not report the discarded packets as lost
+        self._rx_stale = False
+        self._start_rx()
 
     def close_stream(self):
         # self.msg("Closing UDP port....")
-        self.stream_socket.close()
+        self._stop_rx()
+        for shard in self._shards:
+            shard.sock.close()
+        self._shards = []
+        self._ring = None
         self.open_stream_port = False
 
     def info(self):
         self.msg("Gain", self.gain, "dB")
         self.msg("Sampling Frequency", self.srate / 1000, "kHz")
 
-    def bytes_to_int(bytes):
-        result = 0
-        for b in bytes:
-            result = result * 256 + int(b)
-        return result
-
-    # Receives an UDP Stream, processes it and returns an ndarray
-    # of. The offset is eliminated from the stream
-    # if the raw flag is set, the offset is not suppressed
-    def receivePacket(self):
-        rawdata = self.stream_socket.recv(self.packetSize)
-        self.rtpVersion = rawdata[0]
-        self.rtpPayloadType = rawdata[1]
-        self.rtpSeqNum = rawdata[2:4]
-        self.rtpTimestampNs = rawdata[4:8]
-        self.rtpTimestampS = rawdata[8:12]
-        self.oldSeqNum = self.newSeqNum
-        self.newSeqNum = int.from_bytes(self.rtpSeqNum, byteorder='big')
-        if self.oldSeqNum == -1:
-            self.oldSeqNum = self.newSeqNum - 1
-        return rawdata[12:]
-
     # accumulates X seconds of data
     def write_wav(self, seconds, prefix="NeXOS_A2", close=True):
-        if not self.config_info:
-            self.config_info = self.get_config()
+        """
+        Acquires 'seconds' of audio into a preallocated buffer (seconds * srate * 2 bytes, e.g. 4 MB for 10 s at
+        200 kHz) and writes it to a wav file with a single write once the acquisition is finished
+        :param seconds: duration of the recording
+        :param prefix: filename prefix, the UTC timestamp is appended
+        :param close: close the stream socket when finished
+        """
+        self.get_config()  # only queried if the configuration has changed
+        self._ensure_stream()
         # Calculate number of packets
-        if self.open_stream_port == False:
-            self.open_stream(self.streaming_port)
 
         npackets = int(seconds * self.srate / self.samplesPerPacket)
         self.msg("Acquiring during", seconds, "s (", npackets, "packets)")
 
-        timestamp = pd.Timestamp.now(tz="utc")
-        rich.print(f"new wav at time {timestamp}")
-        filename = prefix + "_" + timestamp.strftime("%Y%m%d_%H%M%Sz") + ".wav"
-        obj = wave.open(filename, 'w')
-        obj.setnchannels(1)  # mono
-        obj.setsampwidth(2)
-        obj.setframerate(self.srate)
-        totalPacketsCount = 0
-        while totalPacketsCount < npackets:
-            # dataRaw = append(dataRaw,hydrophone.receivePacket())
-            newPacket = self.receivePacket()
-            obj.writeframesraw(newPacket)
-            totalPacketsCount += 1
-            seqGap = self.newSeqNum - self.oldSeqNum
-            if seqGap > 1:
-                self.msg("Lost: ", seqGap, "packets")
-
-        obj.close()
+        filename = self._wav_filename(prefix)
+        buf = bytearray(npackets * (self.packetSize - 12))  # payload of all packets, headers stripped
+        mv = memoryview(buf)
+        try:
+            off = self._acquire(mv, npackets)
+            tags = id3_chunk(self.config_info)  # metadata written inline, no need to re-open the file
+            # sizes are known, so the header is written once with its final values
+            obj = open_wav_writer(filename, self.srate, use_uring=self.use_uring, nsamples=off // 2,
+                                  trailer_size=len(tags))  # mono, 16 bits
+            obj.write(mv[:off])
+            obj.close(tags)
+        except BaseException:
+            self.close_stream()  # don't leak the receiver threads, the next call reopens the stream
+            raise
+        self.last_samples = np.frombuffer(mv[:off & ~1], dtype="<i2")  # no copy
         if close:
             self.close_stream()
-
-        # Add metadata in a seprate thread
-        metadata_thread = Thread(target=add_id3_tags, args=(filename, self.config_info))
-        metadata_thread.start()
+        else:
+            self._rx_stale = True
         return 1
 
     # accumulates X seconds of data
     def write_wav_continuous(self, seconds, prefix="NeXOS_A2"):
-        while True:
-            self.write_wav(seconds, prefix=prefix)
+        self.record_forever(seconds, prefix=prefix)
+
+    def record_forever(self, seconds_per_file, prefix="NeXOS_A2"):
+        """
+        Records continuously, rolling over to a new wav file every seconds_per_file. The stream socket and the
+        receiver thread are kept open across files, so there is no gap at the file boundaries
+        :param seconds_per_file: duration of each file
+        :param prefix: filename prefix, the UTC timestamp is appended
+        """
+        self.get_config()  # only queried if the configuration has changed
+        self._ensure_stream()
+
+        npackets = int(seconds_per_file * self.srate / self.samplesPerPacket)
+        block = min(npackets, int(self.srate / self.samplesPerPacket))  # write to disk about once per second
+        mv = memoryview(bytearray(block * (self.packetSize - 12)))
+        tags = id3_chunk(self.config_info)
+        self.msg("Recording", seconds_per_file, "s files (", npackets, "packets)")
+        obj = None
+        try:
+            while True:
+                obj = open_wav_writer(self._wav_filename(prefix), self.srate, use_uring=self.use_uring,
+                                      nsamples=npackets * self.samplesPerPacket, trailer_size=len(tags))
+                remaining = npackets
+                while remaining > 0:
+                    n = min(block, remaining)
+                    obj.write(mv[:self._acquire(mv, n)])
+                    remaining -= n
+                obj.close(tags)
+                obj = None
+        finally:
+            if obj:
+                obj.close(tags)  # keep a valid header in the file being recorded when interrupted
+            self.close_stream()
+
+    def _wav_filename(self, prefix) -> str:
+        timestamp = pd.Timestamp.now(tz="utc")
+        rich.print(f"new wav at time {timestamp}")
+        return prefix + "_" + timestamp.strftime("%Y%m%d_%H%M%Sz") + ".wav"
+
+    # -------- Samples analysis -------- #
+    def _samples(self, samples):
+        if samples is None:
+            samples = self.last_samples
+        if samples is None:
+            raise ValueError("no samples acquired, call write_wav first")
+        return samples
+
+    def to_float(self, samples=None) -> np.ndarray:
+        """
+        Converts int16 samples to float32 in the [-1, 1) range
+        :param samples: int16 array, by default the samples of the last write_wav
+        """
+        return self._samples(samples).astype(np.float32) * (1.0 / 32768.0)
 
+    def rms(self, samples=None) -> float:
+        """
+        Returns the RMS value of the samples relative to full scale
+        :param samples: int16 array, by default the samples of the last write_wav
+        """
+        x = self.to_float(samples)
+        return float(np.sqrt(np.mean(x * x, dtype=np.float64)))
 
+    def clip_count(self, samples=None) -> int:
+        """
+        Returns the number of samples at the int16 limits (clipped)
+        :param samples: int16 array, by default the samples of the last write_wav
+        """
+        samples = self._samples(samples)
+        return int(np.count_nonzero((samples == 32767) | (samples == -32768)))
 
     def get_config(self) -> dict:
         """
-        returns a dict with the configuration
+        returns a dict with the configuration, it is only queried again after a set_* method has changed it
         """
+        if not self._config_dirty:
+            return self.config_info
         self.ch = self.get_channel()
         if self.ch == 1:
             self.eq_status = self.get_equalizer()
@@ -394,11 +845,12 @@ class NeXOS:
             "equalizer":self.eq_status
         }
         self.config_info = config
+        self._config_dirty = False
         return config
 
     def start_streaming(self):
         self.set_recv_port(self.streaming_port)
-        self.get_config()  # reload config
+        self.get_config()  # reload config if changed
         self.set("CONFigure:STATe", "RUN_CONTINUOUS")
 
     def stop_streaming(self):
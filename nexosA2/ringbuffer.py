@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Single-producer/single-consumer ring buffer used to decouple the reception of the RTP stream from the wav writer
+
+author: Enoc Martínez
+institution: Universitat Politècnica de Catalunya (UPC)
+email: enoc.martinez@upc.edu
+license: MIT
+created: 20/11/23
+"""
+
+import time
+
+
+class NeXOSRingBuffer:
+    """
+    Lock-free ring of fixed-size packet slots backed by a single preallocated bytearray. Only the producer moves the
+    head and only the consumer moves the tail, both are ever-increasing counters whose stores are atomic under the GIL
+    """
+    def __init__(self, capacity_packets: int, packet_size: int = 1036):
+        """
+        :param capacity_packets: number of slots
+        :param packet_size: size of each slot in bytes
+        """
+        self.capacity = capacity_packets
+        self.packet_size = packet_size
+        self.buffer = bytearray(capacity_packets * packet_size)
+        self.view = memoryview(self.buffer)
+        self.lengths = [0] * capacity_packets  # number of valid bytes in each slot
+        self.head = 0  # packets written (producer only)
+        self.tail = 0  # packets read (consumer only)
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def slot(self, index: int) -> memoryview:
+        """
+        Returns a writable view of the slot at index
+        """
+        off = index * self.packet_size
+        return self.view[off:off + self.packet_size]
+
+    # -------- producer -------- #
+    def head_slot(self) -> int:
+        return self.head % self.capacity
+
+    def writable(self) -> int:
+        """
+        Number of free contiguous slots starting at the head slot (does not wrap around)
+        """
+        free = self.capacity - (self.head - self.tail)
+        return min(free, self.capacity - self.head_slot())
+
+    def commit(self, nbytes: int):
+        """
+        Publishes the head slot, which holds nbytes of data, to the consumer
+        """
+        self.lengths[self.head % self.capacity] = nbytes
+        self.head += 1
+
+    # -------- consumer -------- #
+    def peek(self):
+        """
+        Returns a view of the oldest packet or None if the ring is empty. The view is valid until release() is called
+        """
+        if self.head == self.tail:
+            return None
+        index = self.tail % self.capacity
+        off = index * self.packet_size
+        return self.view[off:off + self.lengths[index]]
+
+    def release(self):
+        """
+        Gives the oldest slot back to the producer
+        """
+        self.tail += 1
+
+    def reset(self):
+        """
+        Discards all the packets in the ring (consumer side)
+        """
+        self.tail = self.head
+
+
+class NeXOSShardedRing:
+    """
+    Consumer side of several NeXOSRingBuffer shards (one per receiver socket). It has the same peek/release interface
+    and returns the packets in RTP sequence order, reading the sequence number from bytes 2-3 of each packet
+    """
+    def __init__(self, rings: list, wait: float = 0.05):
+        """
+        :param rings: list of NeXOSRingBuffer
+        :param wait: max time (seconds) to wait for a missing packet that may still be in flight in an empty shard
+        """
+        self.rings = rings
+        self.wait = wait
+        self.late = 0  # packets discarded because they arrived after a later packet had been returned
+        self.next_seq = -1  # expected sequence number, -1 if unknown
+        self._current = None  # ring of the packet returned by peek
+        self._missing_since = None
+
+    def __len__(self):
+        return sum(len(ring) for ring in self.rings)
+
+    def peek(self):
+        """
+        Returns a view of the next packet in sequence order or None if it is not available yet
+        """
+        best = None
+        best_dist = 0x10000
+        best_seq = 0
+        empty = False
+        for ring in self.rings:
+            packet = ring.peek()
+            if packet is None:
+                empty = True
+                continue
+            if len(packet) < 12:
+                self._current = ring  # not an RTP packet, hand it over right away so the consumer discards it
+                return packet
+            seq = (packet[2] << 8) | packet[3]
+            dist = (seq - self.next_seq) & 0xFFFF if self.next_seq >= 0 else seq
+            if self.next_seq >= 0 and dist >= 0x8000:
+                ring.release()  # behind the expected sequence number, it was already given up as lost
+                self.late += 1
+                empty = True
+                continue
+            if dist < best_dist:
+                best, best_dist, best_seq = ring, dist, seq
+        if best is None:
+            return None
+        if best_dist and empty and self.next_seq >= 0:
+            # the expected packet may be in an empty shard, give it some time before skipping it
+            now = time.monotonic()
+            if self._missing_since is None:
+                self._missing_since = now
+            if now - self._missing_since < self.wait:
+                return None
+        self._missing_since = None
+        self._current = best
+        self.next_seq = (best_seq + 1) & 0xFFFF
+        return best.peek()
+
+    def release(self):
+        self._current.release()
+
+    def reset(self):
+        """
+        Discards all the packets in the shards and forgets the expected sequence number
+        """
+        for ring in self.rings:
+            ring.reset()
+        self.next_seq = -1
+        self._current = None
+        self._missing_since = None
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Linux fast path to write wav files using io_uring and O_DIRECT, so the audio stream does not go through the page
+cache. Requires the optional 'liburing' package (pip install liburing), otherwise open_wav_writer falls back to the
+buffered WavWriter
+
+author: Enoc Martínez
+institution: Universitat Politècnica de Catalunya (UPC)
+email: enoc.martinez@upc.edu
+license: MIT
+created: 20/11/23
+"""
+
+import mmap
+import os
+import struct
+import sys
+from .wavwriter import WavWriter, wav_header
+
+try:
+    import liburing
+except ImportError:
+    liburing = None
+
+BLOCK_SIZE = 4096  # O_DIRECT transfers have to be aligned to the logical block size of the device
+
+
+class UringWavWriter:
+    def __init__(self, filename: str, srate: int, channels: int = 1, sampwidth: int = 2, chunk_size: int = 1 << 20,
+                 batch: int = 4, nsamples: int = 0, trailer_size: int = 0):
+        """
+        Opens a wav file with O_DIRECT. Data is copied into page-aligned chunks, and every 'batch' chunks are
+        submitted with a single io_uring_submit_and_wait call. Raises OSError if the filesystem
+        does not support O_DIRECT or the kernel does not support io_uring
+        :param filename: output file
+        :param srate: sampling rate
+        :param channels: number of channels
+        :param sampwidth: bytes per sample
+        :param chunk_size: size of each write, must be multiple of BLOCK_SIZE
+        :param batch: number of chunks submitted together
+        :param nsamples: expected number of samples per channel, if known the header does not need to be patched
+        :param trailer_size: expected size of the trailer passed to close()
+        """
+        assert chunk_size % BLOCK_SIZE == 0
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.batch = batch
+        self.data_bytes = 0  # payload bytes received
+        self.offset = 0  # file offset of the first chunk of the current batch
+        self.chunks = [mmap.mmap(-1, chunk_size) for _ in range(batch)]  # anonymous mmaps are page aligned
+        self.views = [memoryview(c) for c in self.chunks]
+        self.cur = 0  # chunk being filled
+        self.pos = 0  # bytes used in the current chunk
+
+        self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o644)
+        self.ring = liburing.Ring()
+        self.cqe = liburing.Cqe()
+        try:
+            liburing.io_uring_queue_init(batch, self.ring)
+            liburing.io_uring_register_files(self.ring, liburing.FileIndex([self.fd]))
+        except Exception:
+            os.close(self.fd)
+            raise
+        # The python bindings only take the address of mmap buffers through Iovec, so chunks are written with
+        # writev instead of write_fixed (which would require registering the buffers)
+        self.iovecs = [liburing.Iovec([v]) for v in self.views]
+        self.header_sizes = (nsamples * channels * sampwidth, trailer_size)  # sizes written in the header
+        self.write(wav_header(srate, channels, sampwidth, *self.header_sizes))
+        self.data_bytes = 0
+
+    def write(self, data):
+        """
+        Appends PCM data (any bytes-like object) to the file
+        """
+        data = memoryview(data).cast("B")
+        self.data_bytes += len(data)
+        while data:
+            n = min(len(data), self.chunk_size - self.pos)
+            self.views[self.cur][self.pos:self.pos + n] = data[:n]
+            self.pos += n
+            data = data[n:]
+            if self.pos == self.chunk_size:
+                self.cur += 1
+                self.pos = 0
+                if self.cur == self.batch:
+                    self._submit(self.batch, self.chunk_size)
+
+    def _submit(self, nchunks: int, last_size: int):
+        """
+        Submits the first nchunks chunks (the last one holding last_size bytes) and waits for their completion
+        """
+        for i in range(nchunks):
+            size = self.chunk_size if i < nchunks - 1 else last_size
+            iov = self.iovecs[i] if size == self.chunk_size else liburing.Iovec([self.views[i][:size]])
+            sqe = liburing.io_uring_get_sqe(self.ring)
+            liburing.io_uring_prep_writev(sqe, 0, iov, self.offset + i * self.chunk_size)
+            sqe.flags |= liburing.IOSQE_FIXED_FILE
+            sqe.user_data = size
+        liburing.io_uring_submit_and_wait(self.ring, nchunks)
+        liburing.io_uring_wait_cqes(self.ring, self.cqe, nchunks)
+        try:
+            for i in range(nchunks):
+                cqe = self.cqe[i]
+                if cqe.res != cqe.user_data:
+                    raise OSError(f"io_uring short write to {self.filename}: {cqe.res} of {cqe.user_data} bytes")
+        finally:
+            liburing.io_uring_cq_advance(self.ring, nchunks)
+        self.offset += (nchunks - 1) * self.chunk_size + last_size
+        self.cur = 0
+        self.pos = 0
+
+    def close(self, trailer: bytes = b""):
+        """
+        Writes the pending data, trims the block padding and patches the RIFF and data chunk sizes in the header if
+        they were not known
+        :param trailer: extra RIFF chunks appended after the data chunk, e.g. id3_chunk(tags)
+        """
+        pending = self.cur * self.chunk_size + self.pos
+        if pending:
+            last = self.pos if self.pos else self.chunk_size
+            nchunks = self.cur + 1 if self.pos else self.cur
+            padded = -(-last // BLOCK_SIZE) * BLOCK_SIZE
+            self.views[nchunks - 1][last:padded] = bytes(padded - last)
+            self._submit(nchunks, padded)
+        liburing.io_uring_unregister_files(self.ring)
+        liburing.io_uring_queue_exit(self.ring)
+        os.close(self.fd)
+
+        length = 44 + self.data_bytes
+        pad = self.data_bytes & 1
+        with open(self.filename, "r+b") as f:
+            f.truncate(length)
+            f.seek(length)
+            if pad:
+                f.write(b"\x00")  # chunks are word aligned
+            f.write(trailer)
+            if self.header_sizes != (self.data_bytes, len(trailer)):
+                f.seek(4)
+                f.write(struct.pack("<I", 36 + self.data_bytes + pad + len(trailer)))
+                f.seek(40)
+                f.write(struct.pack("<I", self.data_bytes))
+        self.iovecs = self.views = self.chunks = None  # the Iovec objects hold exports of the mmaps, just drop them
+
+
+def open_wav_writer(filename: str, srate: int, use_uring: bool = False, nsamples: int = 0, trailer_size: int = 0):
+    """
+    Returns an UringWavWriter if use_uring is set and io_uring/O_DIRECT are available, otherwise a WavWriter
+    :param nsamples: expected number of samples, if known the header is written once with its final sizes
+    :param trailer_size: expected size of the trailer passed to close()
+    """
+    if use_uring and liburing and sys.platform == "linux":
+        try:
+            return UringWavWriter(filename, srate, nsamples=nsamples, trailer_size=trailer_size)
+        except (OSError, RuntimeError):
+            pass  # no io_uring or no O_DIRECT support in this filesystem, use the buffered writer
+    return WavWriter(filename, srate, nsamples=nsamples, trailer_size=trailer_size)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Buffered PCM wav writer, it aggregates several packets per write call instead of writing every packet through the
+wave module
+
+author: Enoc Martínez
+institution: Universitat Politècnica de Catalunya (UPC)
+email: enoc.martinez@upc.edu
+license: MIT
+created: 20/11/23
+"""
+
+import struct
+
+# RIFF/WAVE header with a single 'fmt ' (PCM) chunk followed by the 'data' chunk header, 44 bytes
+WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+WAVE_FORMAT_PCM = 0x0001
+
+
+def wav_header(srate: int, channels: int = 1, sampwidth: int = 2, data_bytes: int = 0, trailer_size: int = 0) -> bytes:
+    """
+    Builds the 44-byte wav header, identical to the one generated by the wave module
+    :param srate: sampling rate
+    :param channels: number of channels
+    :param sampwidth: bytes per sample
+    :param data_bytes: size of the PCM payload in bytes
+    :param trailer_size: size of the RIFF chunks after the data chunk (e.g. id3_chunk)
+    """
+    riff_size = 36 + data_bytes + (data_bytes & 1) + trailer_size
+    return WAV_HEADER.pack(b"RIFF", riff_size, b"WAVE", b"fmt ", 16, WAVE_FORMAT_PCM, channels, srate,
+                           channels * srate * sampwidth, channels * sampwidth, sampwidth * 8, b"data", data_bytes)
+
+
+def write_wav_header(fp, srate: int, nsamples: int, channels: int = 1, sampwidth: int = 2, trailer_size: int = 0):
+    """
+    Writes the wav header with its final sizes, for recordings whose length is known beforehand (no back-patching)
+    :param fp: file opened in binary mode
+    :param srate: sampling rate
+    :param nsamples: number of samples per channel
+    :param channels: number of channels
+    :param sampwidth: bytes per sample
+    :param trailer_size: size of the RIFF chunks after the data chunk (e.g. id3_chunk)
+    """
+    fp.write(wav_header(srate, channels, sampwidth, nsamples * channels * sampwidth, trailer_size))
+
+
+def _syncsafe(n: int) -> bytes:
+    """
+    ID3v2.4 sizes are stored in 4 bytes using only the 7 lower bits of each byte
+    """
+    return bytes([(n >> 21) & 0x7F, (n >> 14) & 0x7F, (n >> 7) & 0x7F, n & 0x7F])
+
+
+def id3_chunk(tags: dict) -> bytes:
+    """
+    Builds an 'id3 ' RIFF chunk with an ID3v2.4 tag holding one TXXX (UTF-8) frame per key (the layout mutagen
+    uses for wav files), so it can be appended to the file without re-opening it
+    :param tags: dict with description/value pairs
+    """
+    frames = bytearray()
+    for key, value in tags.items():
+        body = b"\x03" + str(key).encode() + b"\x00" + str(value).encode()
+        frames += b"TXXX" + _syncsafe(len(body)) + b"\x00\x00" + body
+    tag = b"ID3\x04\x00\x00" + _syncsafe(len(frames)) + frames
+    if len(tag) & 1:
+        tag += b"\x00"  # chunks are word aligned
+    return b"id3 " + struct.pack("<I", len(tag)) + tag
+
+
+class WavWriter:
+    def __init__(self, filename: str, srate: int, channels: int = 1, sampwidth: int = 2, flush_size: int = 1 << 16,
+                 nsamples: int = 0, trailer_size: int = 0):
+        """
+        Opens a wav file and writes its header. If the final sizes are given (nsamples, trailer_size) the header is
+        written once, otherwise sizes are patched when the file is closed
+        :param filename: output file
+        :param srate: sampling rate
+        :param channels: number of channels
+        :param sampwidth: bytes per sample
+        :param flush_size: payload is accumulated until flush_size bytes are available and then written at once
+        :param nsamples: expected number of samples per channel
+        :param trailer_size: expected size of the trailer passed to close()
+        """
+        self.filename = filename
+        self.flush_size = flush_size
+        self.data_bytes = 0  # payload bytes written to the file
+        self.out = bytearray()  # payload not written yet
+        self.header_sizes = (nsamples * channels * sampwidth, trailer_size)  # sizes written in the header
+        self.file = open(filename, "wb", buffering=1 << 20)
+        write_wav_header(self.file, srate, nsamples, channels, sampwidth, trailer_size)
+
+    def write(self, data):
+        """
+        Appends PCM data (any bytes-like object) to the file, large blocks are written straight away
+        """
+        if len(data) >= self.flush_size:
+            self.flush()
+            self.file.write(data)
+            self.data_bytes += len(data)
+            return
+        self.out.extend(data)
+        if len(self.out) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.out)
+        self.data_bytes += len(self.out)
+        self.out.clear()
+
+    def close(self, trailer: bytes = b""):
+        """
+        Writes the pending data and patches the RIFF and data chunk sizes in the header if they were not known
+        :param trailer: extra RIFF chunks appended after the data chunk, e.g. id3_chunk(tags)
+        """
+        self.flush()
+        pad = self.data_bytes & 1
+        if pad:
+            self.file.write(b"\x00")  # chunks are word aligned
+        self.file.write(trailer)
+        if self.header_sizes != (self.data_bytes, len(trailer)):
+            self.file.seek(4)
+            self.file.write(struct.pack("<I", 36 + self.data_bytes + pad + len(trailer)))
+            self.file.seek(40)
+            self.file.write(struct.pack("<I", self.data_bytes))
+        self.file.close()